@@ -1,36 +1,218 @@
+import asyncio
+import functools
+import logging
 import os
-import json
-from typing import Dict, Generator, Optional
+import socket
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncGenerator, Dict, Optional
 
-import httpx
 import gradio as gr
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib decoder
+    import json as orjson
+
+logger = logging.getLogger(__name__)
 
 API_URL = os.getenv("RAG_API_URL", "http://localhost:8080")
 
+# One long-lived client so /models and /rag-query/stream reuse pooled
+# keep-alive connections instead of paying a TCP/TLS handshake per request.
+# HTTP/2 lets concurrent chats multiplex over a single connection. It is
+# async so every request runs on Gradio's event loop rather than pinning a
+# worker thread on blocking socket reads.
+# TCP_NODELAY keeps small token frames from being held back by Nagle.
+_ACLIENT = httpx.AsyncClient(
+    base_url=API_URL,
+    headers={"Accept-Encoding": "br, gzip"},
+    timeout=httpx.Timeout(10.0, read=None),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=100,
+            # Outlive the pause between chat turns (httpx defaults to 5 s).
+            keepalive_expiry=60.0,
+        ),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+    ),
+)
+
+# Ask for an uncompressed stream: a compressor between backend and UI may
+# hold tokens back until it has filled a block, delaying every delta.
+_STREAM_HEADERS = {
+    "Accept": "text/event-stream",
+    "Accept-Encoding": "identity",
+    "Content-Type": "application/json",
+}
+
+# Coalesce streamed tokens so the UI is re-rendered at most every ~25 ms
+# (or every 8 KB of new text) instead of once per token.
+_FLUSH_INTERVAL = 0.025
+_FLUSH_BYTES = 8192
+
+# SSE framing, matched on raw bytes in the streaming loop.
+_PFX = b"data: "
+_PFX_N = len(_PFX)
+_DONE = b"[DONE]"
+# Nearly every frame is a bare {"content": "..."} object; when the string
+# has no escapes its bytes are the token itself and JSON parsing is skipped.
+_FAST_PFX = b'{"content": "'  # json.dumps() default separators
+_FAST_PFX_COMPACT = b'{"content":"'
+_FAST_SFX = b'"}'
+_CONTENT_KEY = b'"content"'
+
+# /models rarely changes; share one lookup across all sessions for a minute.
+_MODELS_TTL = 60.0
+# Past the TTL a known catalog is still served while it refreshes, but never
+# once it is older than this, whether it came from the backend or from disk.
+_MODELS_MAX_STALE = 3600.0
+# "t" is when the catalog in "v" was fetched; "raw" is the /models body it
+# was parsed from, used to skip rewriting an unchanged snapshot.
+_models_cache: dict = {"t": float("-inf"), "v": ((), None), "raw": b""}
+_refresh_task: Optional[asyncio.Task] = None
+# "source:name" dropdown label -> backend model name, filled by fetch_models.
+_LABEL_TO_MODEL: dict[str, str] = {}
+_DROPDOWN_KWARGS = dict(interactive=True)
+
 # -----------------------------------------------------------------------------
 # Model helpers (lazy)
 # -----------------------------------------------------------------------------
 
 
-def fetch_models() -> tuple[list[str], Optional[str]]:
-    """Hit /models and return (choices, default). Empty list on failure."""
+def _models_file_path() -> Optional[Path]:
+    """Where the /models snapshot lives, or None if no location resolves.
+
+    The snapshot is reused across restarts so the dropdown can be filled
+    before the backend answers.
+    """
+    if override := os.getenv("RAG_MODELS_CACHE"):
+        return Path(override)
+    try:
+        base = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    except (RuntimeError, KeyError):  # no resolvable home directory
+        return None
+    return Path(base) / "vp-rag" / "models.json"
+
+
+def _parse_models(data: dict) -> tuple[tuple[str, ...], Optional[str]]:
+    """Turn a /models payload into (choices, default) and index the labels.
+
+    Raises on a malformed payload; labels are only indexed on success.
+    """
+    choices, default, labels = [], None, {}
+    default_model = data.get("default_model")
+    for m in data.get("models", []):
+        name = m["name"]
+        label = m["model_type"] + ":" + name
+        choices.append(label)
+        labels[label] = name
+        if default is None and name == default_model:
+            default = label
+    _LABEL_TO_MODEL.update(labels)
+    return tuple(choices), default
+
+
+def _load_models_file() -> None:
+    """Seed the model cache from the on-disk snapshot if it is recent enough.
+
+    Any problem with the file leaves the cache empty; it never stops startup.
+    """
+    if _MODELS_FILE is None:
+        return
     try:
-        r = httpx.get(f"{API_URL}/models", timeout=10)
+        age = time.time() - _MODELS_FILE.stat().st_mtime
+        if age >= _MODELS_MAX_STALE:
+            return
+        raw = _MODELS_FILE.read_bytes()
+        choices, default = _parse_models(orjson.loads(raw))
+    except FileNotFoundError:
+        return
+    except Exception as exc:
+        logger.warning("⚠️ Ignoring models cache %s: %s", _MODELS_FILE, exc)
+        return
+    if choices:
+        _models_cache.update(t=time.monotonic() - age, v=(choices, default), raw=raw)
+
+
+def _store_models_file(raw: bytes) -> None:
+    if _MODELS_FILE is None:
+        return
+    try:
+        if raw == _models_cache["raw"]:
+            # Unchanged: just mark the snapshot as freshly confirmed.
+            try:
+                os.utime(_MODELS_FILE)
+                return
+            except FileNotFoundError:  # snapshot was removed; write it again
+                pass
+        _MODELS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = _MODELS_FILE.with_suffix(".tmp")
+        tmp.write_bytes(raw)
+        tmp.replace(_MODELS_FILE)
+    except OSError as exc:
+        logger.warning("⚠️ Could not write models cache: %s", exc)
+
+
+async def _fetch_models_remote() -> tuple[tuple[str, ...], Optional[str]]:
+    try:
+        r = await _ACLIENT.get("/models", timeout=10)
         r.raise_for_status()
-        data = r.json()
+        choices, default = _parse_models(orjson.loads(r.content))
     except Exception as exc:
-        print("⚠️ Could not fetch /models:", exc)
-        return [], None
+        logger.warning("⚠️ Could not fetch /models: %s", exc)
+        return (), None
+    logger.debug("/models answered over %s", r.http_version)
 
-    choices = [f"{m['model_type']}:{m['name']}" for m in data.get("models", [])]
-    default = next(
-        (c for c in choices if c.split(":", 1)[1] == data.get("default_model")),
-        None,
-    )
+    if choices:
+        _store_models_file(r.content)
+        _models_cache.update(t=time.monotonic(), v=(choices, default), raw=r.content)
     return choices, default
 
 
+def _refresh_done(task: asyncio.Task) -> None:
+    global _refresh_task
+    _refresh_task = None
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        logger.warning("⚠️ Background /models refresh failed: %s", exc)
+
+
+async def fetch_models(force: bool = False) -> tuple[tuple[str, ...], Optional[str]]:
+    """Hit /models and return (choices, default). Empty list on failure.
+
+    Successful results are cached for ``_MODELS_TTL`` seconds unless ``force``.
+    After that, the last known catalog (possibly the on-disk snapshot from a
+    previous run) is returned right away while a background task refreshes
+    it, for as long as it is younger than ``_MODELS_MAX_STALE``.
+    """
+    global _refresh_task
+    age = time.monotonic() - _models_cache["t"]
+    if not force:
+        if age < _MODELS_TTL:
+            return _models_cache["v"]
+        if _models_cache["v"][0] and age < _MODELS_MAX_STALE:
+            if _refresh_task is None:
+                _refresh_task = asyncio.create_task(_fetch_models_remote())
+                _refresh_task.add_done_callback(_refresh_done)
+            return _models_cache["v"]
+    return await _fetch_models_remote()
+
+
+_MODELS_FILE = _models_file_path()
+_load_models_file()
+
+
 def label_to_model(choice: str | None) -> str | None:
+    model = _LABEL_TO_MODEL.get(choice)
+    if model is not None:
+        return model
     return choice.split(":", 1)[1] if choice and ":" in choice else choice
 
 
@@ -39,31 +221,69 @@ def label_to_model(choice: str | None) -> str | None:
 # -----------------------------------------------------------------------------
 
 
-def stream_chat(
-    question: str, chat_history: list[Dict[str, str]], model_choice: str | None
-) -> Generator[str, None, None]:
-    prev = chat_history[:-2] if len(chat_history) >= 2 else []
-    history_flat = [m["content"] for m in prev if m.get("content")]
-
+async def stream_chat(
+    question: str, history_flat: list[str], model_choice: str | None
+) -> AsyncGenerator[bytes, None]:
+    """Yield the answer as UTF-8 bytes, one piece per network read."""
     payload = {"question": question, "history": history_flat}
     model_name = label_to_model(model_choice)
     if model_name:
         payload["model"] = model_name
 
-    with httpx.stream(
-        "POST", f"{API_URL}/rag-query/stream", json=payload, timeout=None
+    async with _ACLIENT.stream(
+        "POST",
+        "/rag-query/stream",
+        content=orjson.dumps(payload),
+        headers=_STREAM_HEADERS,
     ) as r:
-        for raw in r.iter_lines():
-            if not raw or not raw.startswith("data: "):
-                continue
-            chunk = raw[6:]
-            if chunk.strip() == "[DONE]":
-                break
-            try:
-                token = json.loads(chunk)["content"]
-            except (json.JSONDecodeError, KeyError):
-                continue
-            yield token
+        # Split SSE lines on raw bytes ourselves: cheaper than aiter_lines(),
+        # which decodes and allocates a str per line. orjson takes bytes.
+        # Consumed lines are dropped once per chunk rather than once per line,
+        # and a carried-over partial line is not rescanned for b"\n". Tokens
+        # from one read are yielded together to save a generator hop each.
+        buf = bytearray()
+        async for chunk in r.aiter_bytes():
+            scan = len(buf)
+            buf.extend(chunk)
+            start = 0
+            parts = []
+            while (nl := buf.find(b"\n", scan)) != -1:
+                line = bytes(buf[start:nl])
+                start = scan = nl + 1
+                if line.endswith(b"\r"):
+                    line = line[:-1]
+                if line.startswith(_PFX):
+                    data = line[_PFX_N:]
+                elif line.startswith(b"data:"):  # the space is optional per spec
+                    data = line[5:]
+                else:
+                    continue
+                if data == _DONE:
+                    if parts:
+                        yield b"".join(parts)
+                    return
+                if data.endswith(_FAST_SFX):
+                    if data.startswith(_FAST_PFX):
+                        raw = data[len(_FAST_PFX) : -len(_FAST_SFX)]
+                    elif data.startswith(_FAST_PFX_COMPACT):
+                        raw = data[len(_FAST_PFX_COMPACT) : -len(_FAST_SFX)]
+                    else:
+                        raw = None
+                    if raw is not None and b'"' not in raw and b"\\" not in raw:
+                        parts.append(raw)
+                        continue
+                if _CONTENT_KEY not in data:  # role-only / finish-only frames
+                    continue
+                if data.startswith(b"{"):
+                    try:
+                        parts.append(orjson.loads(data)["content"].encode())
+                        continue
+                    except (orjson.JSONDecodeError, KeyError, AttributeError):
+                        pass
+                logger.warning("Skipping malformed SSE frame: %r", data[:80])
+            del buf[:start]
+            if parts:
+                yield b"".join(parts)
 
 
 # -----------------------------------------------------------------------------
@@ -71,28 +291,65 @@ def stream_chat(
 # -----------------------------------------------------------------------------
 
 
-def respond(message: str, chat_history: list[Dict[str, str]], model_choice: str):
+async def respond(
+    message: str,
+    chat_history: list[Dict[str, str]],
+    history_flat: list[str],
+    model_choice: str,
+):
+    """Stream an answer into the chat.
+
+    ``chat_history`` comes from a server-side ``gr.State`` so the browser
+    never uploads the conversation. The new list is stored back into that
+    state on the first yield and then mutated in place, so later yields
+    leave the state (and the textbox) untouched.
+
+    ``history_flat`` is the non-empty message texts the backend expects as
+    ``history``. It is kept in its own append-only state and extended once
+    per turn, rather than re-projected from ``chat_history`` every time.
+    """
     chat_history = chat_history + [
         {"role": "user", "content": message},
         {"role": "assistant", "content": ""},
     ]
-    yield chat_history, ""  # clear textbox
+    yield chat_history, "", chat_history  # clear textbox
+
+    # Accumulate into a bytearray and only materialise the answer string at
+    # flush time; `str +=` copies the whole answer once chat_history holds a
+    # second reference to it, making the build quadratic in tokens. Chunks
+    # arrive as bytes, so unescaped tokens are never decoded one by one.
+    buf = bytearray()
+    flushed = 0
+    clock = asyncio.get_running_loop().time
+    last_flush = clock()
+    try:
+        async for chunk in stream_chat(message, history_flat, model_choice):
+            buf.extend(chunk)
+            now = clock()
+            if (
+                now - last_flush >= _FLUSH_INTERVAL
+                or len(buf) - flushed >= _FLUSH_BYTES
+            ):
+                chat_history[-1]["content"] = buf.decode()
+                flushed, last_flush = len(buf), now
+                yield chat_history, gr.update(), gr.update()
 
-    buf = ""
-    for token in stream_chat(message, chat_history, model_choice):
-        buf += token
-        chat_history[-1]["content"] = buf
-        yield chat_history, ""
+        if len(buf) != flushed:
+            chat_history[-1]["content"] = buf.decode()
+            yield chat_history, gr.update(), gr.update()
+    finally:
+        # Record the turn even if it was cut short, matching chat_history.
+        history_flat.extend(filter(None, (message, buf.decode())))
 
 
-def refresh_dropdown():
+async def refresh_dropdown(force: bool = False):
     """Return an update dict compatible with all Gradio versions."""
-    choices, default = fetch_models()
+    choices, default = await fetch_models(force)
     if not choices:
         return gr.update(
             choices=["⚠️ backend unreachable"], value=None, interactive=False
         )
-    return gr.update(choices=choices, value=default, interactive=True)
+    return gr.update(choices=choices, value=default, **_DROPDOWN_KWARGS)
 
 
 # -----------------------------------------------------------------------------
@@ -113,6 +370,8 @@ with gr.Blocks(title="Validated Patterns RAG Chat", theme="soft") as demo:
     chatbot = gr.Chatbot(
         label="Conversation", height=500, show_copy_button=True, type="messages"
     )
+    history_state = gr.State([])
+    history_flat_state = gr.State([])
 
     with gr.Row():
         msg = gr.Textbox(
@@ -129,12 +388,57 @@ with gr.Blocks(title="Validated Patterns RAG Chat", theme="soft") as demo:
 
     # Events
     demo.load(refresh_dropdown, None, model_sel)
-    refresh_btn.click(refresh_dropdown, None, model_sel)
+    refresh_btn.click(functools.partial(refresh_dropdown, force=True), None, model_sel)
 
-    for trg in (msg.submit, send_btn.click):
-        trg(respond, inputs=[msg, chatbot, model_sel], outputs=[chatbot, msg])
+    # One event for both triggers, so trigger_mode="once" drops an Enter or
+    # Send while an answer is still streaming instead of starting a second
+    # respond on the same history.
+    chat_event = gr.on(
+        triggers=[msg.submit, send_btn.click],
+        fn=respond,
+        inputs=[msg, history_state, history_flat_state, model_sel],
+        outputs=[chatbot, msg, history_state],
+        trigger_mode="once",
+    )
+
+    # Clearing cancels any in-flight answer; the cancelled task exits the
+    # `async with` in stream_chat, closing the stream so the backend stops.
+    clear_btn.click(
+        lambda: ([], "", [], []),
+        None,
+        [chatbot, msg, history_state, history_flat_state],
+        queue=False,
+        cancels=[chat_event],
+    )
+
+
+# -----------------------------------------------------------------------------
+# Server
+# -----------------------------------------------------------------------------
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Runs on the server's own loop, where the pooled connections live.
+    await _ACLIENT.aclose()
 
-    clear_btn.click(lambda: ([], ""), None, [chatbot, msg], queue=False)
 
 if __name__ == "__main__":
-    demo.launch()
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # Serve the Blocks from our own uvicorn so the server settings are ours:
+    # "auto" resolves to uvloop/httptools when installed, and per-request
+    # access logging is off.
+    app = gr.mount_gradio_app(FastAPI(lifespan=lifespan), demo, path="/")
+    uvicorn.run(
+        app,
+        host=os.getenv("GRADIO_SERVER_NAME", "127.0.0.1"),
+        port=int(os.getenv("GRADIO_SERVER_PORT", "7860")),
+        loop="auto",
+        http="auto",
+        access_log=False,
+        log_level="info",
+    )